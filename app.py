@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
 import os
+import sys
 import io
+import atexit
+import csv
+import functools
+import hashlib
 import json
+import multiprocessing
+import shutil
 import tempfile
+import threading
+import time
 import traceback
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 import numpy as np
-import pandas as pd
+import orjson
 from flask import Flask, request, jsonify, send_file, send_from_directory
-
-from fmpy import read_model_description, simulate_fmu
-from fmpy import platform as fmpy_platform
-from fmpy.validation import validate_fmu
+from werkzeug.exceptions import RequestEntityTooLarge
 
 
 app = Flask(__name__, static_url_path='', static_folder='static')
@@ -21,95 +29,248 @@ app = Flask(__name__, static_url_path='', static_folder='static')
 # Simple in-memory store for last uploaded FMU per process (for demo)
 SESSION: Dict[str, Any] = {}
 
+# Worker pool for multi-run sweeps ("runs" in the /api/run payload), created on first use
+SWEEP_POOL: Optional[ProcessPoolExecutor] = None
+_SWEEP_POOL_LOCK = threading.Lock()
+
+# Runs currently using each extracted FMU directory, and replaced extractions
+# waiting to be removed once no run uses them (or to be retried, on Windows,
+# when a DLL inside was still loaded)
+_EXTRACTION_USERS: Dict[str, int] = {}
+_RETIRED_EXTRACTIONS: set = set()
+_EXTRACTIONS_LOCK = threading.Lock()
+
+# Where uploads and results are stored. /api/download doesn't look at this
+# directory: it only serves files registered in SESSION['downloads']
+UPLOAD_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+
+# Largest accepted upload; Flask rejects bigger request bodies before parsing
+# them, and save_upload() re-checks the size while streaming the file
+MAX_UPLOAD_MB = 512
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Uploaded files and results older than this are removed on the next upload
+UPLOAD_MAX_AGE_HOURS = 24
+
+# Most recent FMI call log records kept per run (older ones are dropped)
+FMI_LOG_MAX_LINES = 10_000
+
+# Use the Numba ZOH kernel (when available) once a schedule or the merged
+# time grid reaches this many points; below it the JIT overhead isn't worth it
+NUMBA_MIN_POINTS = 10_000
+
+# Without Numba, resample signals on a thread pool (NumPy releases the GIL)
+# once there are at least this many signals and merged time points
+RESAMPLE_THREADS_MIN_SIGNALS = 4
+RESAMPLE_THREADS_MIN_ROWS = 10_000
+RESAMPLE_POOL: Optional[ThreadPoolExecutor] = None
+
 
 # ---------- Helpers ----------
 
-def normalize_inputs(input_cfg: Optional[List]) -> Optional[List]:
-    """Convert string numbers to floats; keep [name, [[t, v], ...]] shape."""
+# FMPy, pyarrow and numba are imported on first use so the worker starts fast
+# and endpoints that don't need them (static files, downloads) never load them.
+
+@functools.lru_cache(maxsize=1)
+def _fmpy():
+    """The fmpy package (with fmpy.validation loaded)."""
+    import fmpy
+    import fmpy.validation
+    return fmpy
+
+
+@functools.lru_cache(maxsize=1)
+def _pyarrow_csv():
+    """(pyarrow, pyarrow.csv)."""
+    import pyarrow
+    import pyarrow.csv
+    return pyarrow, pyarrow.csv
+
+
+def parse_input_schedules(input_cfg: Optional[List]) -> Optional[List[Tuple[str, np.ndarray]]]:
+    """
+    Convert the payload's [ [name, [[t, v], ...]], ... ] (numbers or numeric
+    strings) to [(name, (N, 2) float64 array), ...] in one C-level cast per
+    signal; done once at the API boundary. Raises ValueError on bad values
+    or on schedules that aren't a list of [t, v] pairs.
+    """
     if not input_cfg:
         return None
-    normalized = []
+    schedules = []
     for name, pairs in input_cfg:
-        fixed_pairs = []
-        for t, v in pairs:
-            fixed_pairs.append([float(t), float(v)])
-        normalized.append([name, fixed_pairs])
-    return normalized
+        if not len(pairs):
+            schedules.append((name, np.empty((0, 2))))
+            continue
+        arr = np.asarray(pairs, dtype=np.float64)
+        if arr.ndim != 2 or arr.shape[1] != 2:
+            raise ValueError(f"{name}: expected a list of [t, v] pairs")
+        schedules.append((name, arr))
+    return schedules
 
 
-def build_structured_input(input_cfg: Optional[List]) -> Optional[np.ndarray]:
+@functools.lru_cache(maxsize=1)
+def _zoh_kernel():
+    """
+    Numba kernel filling every signal's ZOH column in parallel, or None when
+    numba (an optional dependency) isn't installed.
     """
-    Convert config format [ [name, [[t, v], ...]], ... ] to a structured NumPy array
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(cache=True, parallel=True, boundscheck=False)
+    def zoh_fill_all(times, ts_flat, vs_flat, offsets, out):
+        # Signal k's samples are ts_flat/vs_flat[offsets[k]:offsets[k + 1]];
+        # a two-pointer sweep over the merged grid writes them to out[:, k].
+        for k in prange(offsets.shape[0] - 1):
+            lo, hi = offsets[k], offsets[k + 1]
+            if lo == hi:
+                out[:, k] = 0.0
+                continue
+            idx = lo
+            last = vs_flat[lo]
+            for i in range(times.shape[0]):
+                while idx + 1 < hi and ts_flat[idx + 1] <= times[i] + 1e-15:
+                    idx += 1
+                    last = vs_flat[idx]
+                out[i, k] = last
+
+    return zoh_fill_all
+
+
+# Numba's default (workqueue) threading layer can't launch parallel kernels
+# from several threads at once, so the kernel call is serialized
+_ZOH_KERNEL_LOCK = threading.Lock()
+
+
+def _zoh_column(t_arr: np.ndarray, v_arr: np.ndarray, query: np.ndarray, out: np.ndarray) -> None:
+    """NumPy ZOH of one signal onto the query grid, written into out."""
+    if not t_arr.size:
+        out[:] = 0.0
+        return
+    idx = np.searchsorted(t_arr, query, side='right') - 1
+    np.clip(idx, 0, t_arr.size - 1, out=idx)
+    np.take(v_arr, idx, out=out)
+
+
+def get_resample_pool() -> ThreadPoolExecutor:
+    """Thread pool for per-signal resampling, created on first use."""
+    global RESAMPLE_POOL
+    if RESAMPLE_POOL is None:
+        RESAMPLE_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return RESAMPLE_POOL
+
+
+def build_structured_input(input_cfg: Optional[List[Tuple[str, np.ndarray]]]) -> Optional[np.ndarray]:
+    """
+    Convert schedules from parse_input_schedules() to a structured NumPy array
     dtype: [('time', float64), (name1, float64), ...] with ZOH between points.
     Returns None if no samples.
     """
     if not input_cfg:
         return None
 
-    input_cfg = normalize_inputs(input_cfg)
-
     series = {}
-    all_times = set()
-    for name, samples in input_cfg:
-        ts = [(float(t), float(v)) for t, v in samples]
-        ts.sort(key=lambda x: x[0])
-        series[name] = ts
-        for t, _ in ts:
-            all_times.add(t)
-
-    if not all_times:
+    per_sig_t = []
+    for name, pairs in input_cfg:
+        order = np.argsort(pairs[:, 0], kind='stable')
+        t_arr = pairs[order, 0]
+        v_arr = pairs[order, 1]
+        series[name] = (t_arr, v_arr)
+        per_sig_t.append(t_arr)
+
+    # Merged time grid (np.unique returns it sorted)
+    times = np.unique(np.concatenate(per_sig_t))
+    if times.size == 0:
         return None
 
-    times = np.array(sorted(all_times), dtype=np.float64)
-    dtype = [('time', np.float64)] + [(n, np.float64) for n in series.keys()]
-    data = np.zeros(times.shape[0], dtype=dtype)
-    data['time'] = times
-
-    for n, ts in series.items():
-        if not ts:
-            data[n] = 0.0
-            continue
-        idx = 0
-        last = ts[0][1]
-        for i, t in enumerate(times):
-            while idx + 1 < len(ts) and ts[idx + 1][0] <= t + 1e-15:
-                idx += 1
-                last = ts[idx][1]
-            data[n][i] = last
-
-    return data
+    names = list(series)
+    dtype = np.dtype({'names': ['time', *names], 'formats': [np.float64] * (len(names) + 1)})
+
+    # Fill a column-major (T, 1 + S) float64 buffer so every signal is written
+    # contiguously, then convert it to row-major once and reinterpret the rows
+    # as the structured dtype (every field is float64, so the layout matches).
+    buf = np.empty((times.shape[0], 1 + len(names)), dtype=np.float64, order='F')
+    buf[:, 0] = times
+
+    # Zero-order hold: each row takes the last sample at or before its time
+    # (samples before the first one hold the first value).
+    sizes = [series[name][0].size for name in names]
+    zoh_fill_all = _zoh_kernel() if max(sum(sizes), times.shape[0]) >= NUMBA_MIN_POINTS else None
+    if zoh_fill_all is not None:
+        # One compiled pass over all signals, flattened into ragged arrays
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        ts_flat = np.concatenate([series[name][0] for name in names])
+        vs_flat = np.concatenate([series[name][1] for name in names])
+        with _ZOH_KERNEL_LOCK:
+            zoh_fill_all(times, ts_flat, vs_flat, offsets, buf[:, 1:])
+        return np.ascontiguousarray(buf).view(dtype)[:, 0]
+
+    query = times + 1e-15
+    columns = [(*series[name], query, buf[:, j]) for j, name in enumerate(names, start=1)]
+    if len(names) >= RESAMPLE_THREADS_MIN_SIGNALS and times.shape[0] >= RESAMPLE_THREADS_MIN_ROWS:
+        # Signals are independent and each writes its own column
+        list(get_resample_pool().map(lambda args: _zoh_column(*args), columns))
+    else:
+        for args in columns:
+            _zoh_column(*args)
+
+    return np.ascontiguousarray(buf).view(dtype)[:, 0]
 
 
 def summarize_variables(md) -> Dict[str, Any]:
     """Return variables grouped by causality + defaults."""
-    params, inputs, outputs, indep = [], [], [], []
+    buckets = {"parameter": [], "input": [], "output": [], "independent": []}
+    ignored: List[Dict[str, Any]] = []  # other causalities (local, calculatedParameter, ...)
     seen = set()
+    # Bound methods as locals: this loop runs once per variable (10k+ on large FMUs)
+    seen_add, get_bucket = seen.add, buckets.get
     for v in md.modelVariables:
-        if v.name in seen:
+        name = v.name
+        if name in seen:
             continue
-        seen.add(v.name)
-        entry = {
-            "name": v.name,
+        seen_add(name)
+        causality = v.causality
+        try:
+            variability, start, description = v.variability, v.start, v.description
+        except AttributeError:  # not every FMPy version defines all of them
+            variability = getattr(v, "variability", None)
+            start = getattr(v, "start", None)
+            description = getattr(v, "description", None)
+        get_bucket(causality, ignored).append({
+            "name": name,
             "type": v.type,
-            "causality": v.causality,
-            "variability": getattr(v, "variability", None),
-            "start": getattr(v, "start", None),
-            "description": getattr(v, "description", None),
-        }
-        if v.causality == "parameter":
-            params.append(entry)
-        elif v.causality == "input":
-            inputs.append(entry)
-        elif v.causality == "output":
-            outputs.append(entry)
-        elif v.causality == "independent":
-            indep.append(entry)
-    return {"parameters": params, "inputs": inputs, "outputs": outputs, "independent": indep}
-
-
-def generate_template(fmu_path: str) -> Dict[str, Any]:
-    """Create a config template using FMU metadata (general for any FMU)."""
-    md = read_model_description(fmu_path)
+            "causality": causality,
+            "variability": variability,
+            "start": start,
+            "description": description,
+        })
+    return {
+        "parameters": buckets["parameter"],
+        "inputs": buckets["input"],
+        "outputs": buckets["output"],
+        "independent": buckets["independent"],
+    }
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_md(fmu_path: str, mtime: float):
+    """Parsed modelDescription, keyed by path + mtime so a rewritten FMU is re-read."""
+    return _fmpy().read_model_description(fmu_path)
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_template(fmu_path: str, mtime: float) -> Dict[str, Any]:
+    """generate_template() cached like _cached_md(); uploads live under their content hash."""
+    return generate_template(fmu_path, _cached_md(fmu_path, mtime))
+
+
+def generate_template(fmu_path: str, md=None) -> Dict[str, Any]:
+    """Create a config template using FMU metadata (general for any FMU); pass md if already parsed."""
+    if md is None:
+        md = _cached_md(fmu_path, os.path.getmtime(fmu_path))
     defexp = getattr(md, "defaultExperiment", None)
     start_time = getattr(defexp, "startTime", None) or 0.0
     stop_time = getattr(defexp, "stopTime", None) or (start_time + 10.0)
@@ -168,7 +329,7 @@ def generate_template(fmu_path: str) -> Dict[str, Any]:
             "coSimulation": md.coSimulation is not None,
             "modelExchange": md.modelExchange is not None
         },
-        "platform": fmpy_platform,  # Using the correct variable name
+        "platform": _fmpy().platform,
         "info": {
             "fmiVersion": md.fmiVersion,
             "modelName": getattr(md, 'modelName', 'Unknown'),
@@ -179,23 +340,312 @@ def generate_template(fmu_path: str) -> Dict[str, Any]:
     }
 
 
-def make_fmi_call_logger(buffer: List[str]):
-    """Capture FMI calls/log lines in-memory for returning to the UI."""
-    def logger(*args):
+def write_result_csv(result: np.ndarray, path: str) -> None:
+    """
+    Write a structured simulation result to CSV with Arrow's C++ writer.
+    Header and NaN (empty field) are written like DataFrame.to_csv did.
+    """
+    pa, pacsv = _pyarrow_csv()
+    names = list(result.dtype.names)
+    # from_pandas=True turns NaN into nulls, which Arrow writes as empty fields
+    columns = [pa.array(np.ascontiguousarray(result[n]), from_pandas=True) for n in names]
+    table = pa.Table.from_arrays(columns, names=names)
+    header = io.StringIO()
+    csv.writer(header, lineterminator='\n').writerow(names)
+    with open(path, 'wb') as f:
+        f.write(header.getvalue().encode('utf-8'))
+        pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(include_header=False, batch_size=65536))
+
+
+def save_upload(file, path: str, max_bytes: Optional[int] = None,
+                chunk_size: int = 1 << 20) -> Optional[str]:
+    """
+    Stream an uploaded file to path in chunks, hashing it on the way.
+    Returns the hex SHA-256, or None (and removes the partial file) if the
+    upload exceeds max_bytes (default: MAX_UPLOAD_MB).
+    """
+    if max_bytes is None:
+        max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+    h = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            size += len(chunk)
+            if size > max_bytes:
+                break
+            h.update(chunk)
+            out.write(chunk)
+    if size > max_bytes:
+        os.remove(path)
+        return None
+    return h.hexdigest()
+
+
+def register_download(path: str) -> None:
+    """Allow /api/download to serve this file (stored by resolved path)."""
+    SESSION.setdefault('downloads', set()).add(os.path.realpath(path))
+
+
+def cleanup_old_files(upload_dir: str, max_age_hours: float = UPLOAD_MAX_AGE_HOURS) -> int:
+    """
+    Delete files under upload_dir (including the per-FMU subdirectories)
+    last modified more than max_age_hours ago, except the ones the session
+    still points at, then the subdirectories left empty. Returns the number
+    of files removed.
+    """
+    cutoff = time.time() - max_age_hours * 3600
+    keep = {SESSION.get('fmu_path'), SESSION.get('input_file')}
+    removed = 0
+    pending = [upload_dir]
+    subdirs = []
+    while pending:
         try:
-            if len(args) == 1:
-                buffer.append(str(args[0]))
-            else:
-                # comp, name, status, message (format varies)
-                comp, name, status, message = args
-                buffer.append(f"[FMI] {name} -> {status} | {message}")
-        except Exception:
-            buffer.append(" ".join(str(a) for a in args))
+            it = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False) or entry.path in keep:
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        SESSION.get('downloads', set()).discard(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+    # Deepest first; non-empty ones (e.g. being filled by an upload right now) stay
+    for path in reversed(subdirs):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    return removed
+
+
+def _orjson_default(obj):
+    """Fallback for values orjson can't serialize natively (e.g. string arrays)."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    raise TypeError
+
+
+def json_response(obj: Any, status: int = 200, pretty: bool = False):
+    """
+    JSON response encoded with orjson (NumPy arrays serialized natively);
+    compact unless pretty. Already-encoded bytes (see below) are sent as is.
+    """
+    if isinstance(obj, bytes):
+        body = obj
+    else:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=_orjson_default, option=option)
+    return app.response_class(body, status=status, mimetype='application/json')
+
+
+# Pre-encoded bodies for the fixed error replies of /api/run and /api/download
+FMU_NOT_FOUND_JSON = orjson.dumps({"ok": False, "error": "FMU not found. Upload first."})
+FILE_NOT_FOUND_JSON = orjson.dumps({"error": "File not found"})
+
+
+def result_payload(result: np.ndarray, out_csv: str,
+                   preview_rows: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Save a simulation result as CSV and build its JSON payload. With
+    preview_rows, "data" only carries the first rows (the CSV has them all).
+    """
+    write_result_csv(result, out_csv)
+    register_download(out_csv)
+
+    # Columnar data straight from the structured array; json_response()
+    # serializes the contiguous column arrays without boxing every value
+    columns = list(result.dtype.names)
+    shown = result if preview_rows is None else result[:preview_rows]
+    return {
+        "columns": columns,
+        "data": {n: np.ascontiguousarray(shown[n]) for n in columns},
+        "csv": out_csv,
+        "total_rows": len(result)
+    }
+
+
+def simulate_in_worker(kwargs: Dict[str, Any]) -> Tuple[bytes, np.dtype, List[str]]:
+    """Sweep worker: run one simulation and return the raw result bytes, dtype and logs."""
+    records: Deque[tuple] = deque(maxlen=FMI_LOG_MAX_LINES)
+    if kwargs.get("debug_logging"):
+        kwargs["fmi_call_logger"] = make_fmi_call_logger(records)
+    result = _fmpy().simulate_fmu(**kwargs)
+    return result.tobytes(), result.dtype, format_fmi_log(records)
+
+
+def get_sweep_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for sweeps, one worker per CPU. Workers are spawned, not
+    forked: the pool starts inside a request thread while other threads
+    (resampling, Numba) may be running, and Windows only has spawn anyway.
+    """
+    global SWEEP_POOL
+    with _SWEEP_POOL_LOCK:
+        if SWEEP_POOL is None:
+            workers = os.cpu_count() or 1
+            if sys.platform == 'win32':
+                # ProcessPoolExecutor's limit there (WaitForMultipleObjects)
+                workers = min(61, workers)
+            SWEEP_POOL = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return SWEEP_POOL
+
+
+def discard_sweep_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken sweep pool so the next sweep starts fresh workers."""
+    global SWEEP_POOL
+    with _SWEEP_POOL_LOCK:
+        if SWEEP_POOL is pool:
+            SWEEP_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_sweep(kwargs: Dict[str, Any], runs: List[Dict[str, Any]], csv_prefix: str,
+              logs: List[str], preview_rows: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Run every entry of a sweep in the process pool. Each run may override
+    "start_values" (merged over the base ones) and "inputs".
+    """
+    # The FMI call logger closure can't be pickled; workers create their own
+    base = {k: v for k, v in kwargs.items() if k != "fmi_call_logger"}
+    pool = get_sweep_pool()
+    jobs = []
+    payloads = []
+    try:
+        for run in runs:
+            run_kwargs = dict(base)
+            if run.get("start_values"):
+                run_kwargs["start_values"] = {**base.get("start_values", {}), **run["start_values"]}
+            if run.get("inputs"):
+                run_kwargs["input"] = build_structured_input(run["inputs"])
+            jobs.append(pool.submit(simulate_in_worker, run_kwargs))
+
+        for i, job in enumerate(jobs):
+            raw, dtype, run_logs = job.result()
+            logs.extend(f"[run {i}] {line}" for line in run_logs)
+            result = np.frombuffer(raw, dtype=dtype)
+            payloads.append(result_payload(result, f"{csv_prefix}_{i}.csv", preview_rows))
+    except BrokenProcessPool:
+        # A worker died (e.g. the FMU's native code crashed) and took the
+        # pool with it; replace the pool so later sweeps still work
+        discard_sweep_pool(pool)
+        raise RuntimeError(f"A sweep worker crashed after {len(payloads)} of {len(runs)} runs; "
+                           "the sweep was aborted")
+    return payloads
+
+
+def shutdown_sweep_pool() -> None:
+    """Stop the sweep workers (if they were started)."""
+    if SWEEP_POOL is not None:
+        SWEEP_POOL.shutdown(cancel_futures=True)
+
+
+def set_session_extraction(unzipdir: str, md) -> None:
+    """Make unzipdir the session FMU's extraction; the previous one is removed once unused."""
+    with _EXTRACTIONS_LOCK:
+        previous = SESSION.get('unzipdir')
+        if previous and previous != unzipdir:
+            _RETIRED_EXTRACTIONS.add(previous)
+        SESSION['unzipdir'] = unzipdir
+        SESSION['md'] = md
+    remove_retired_extractions()
+
+
+def acquire_session_extraction(fmu_path: str) -> Optional[Tuple[str, Any]]:
+    """
+    (unzipdir, md) of the session FMU if fmu_path is it, else None. The
+    directory is kept until the matching release_extraction() call.
+    """
+    with _EXTRACTIONS_LOCK:
+        unzipdir = SESSION.get('unzipdir')
+        if not unzipdir or fmu_path != SESSION.get('fmu_path'):
+            return None
+        _EXTRACTION_USERS[unzipdir] = _EXTRACTION_USERS.get(unzipdir, 0) + 1
+        return unzipdir, SESSION['md']
+
+
+def release_extraction(unzipdir: str) -> None:
+    """Counterpart of acquire_session_extraction()."""
+    with _EXTRACTIONS_LOCK:
+        users = _EXTRACTION_USERS.pop(unzipdir) - 1
+        if users:
+            _EXTRACTION_USERS[unzipdir] = users
+    remove_retired_extractions()
+
+
+def remove_retired_extractions() -> None:
+    """Delete replaced extractions no run is using; ones that can't be deleted yet are retried later."""
+    with _EXTRACTIONS_LOCK:
+        idle = [d for d in _RETIRED_EXTRACTIONS if d not in _EXTRACTION_USERS]
+    for unzipdir in idle:
+        shutil.rmtree(unzipdir, ignore_errors=True)
+        if os.path.exists(unzipdir):
+            print(f"Debug: Could not remove {unzipdir} yet, will retry")
+            continue
+        with _EXTRACTIONS_LOCK:
+            _RETIRED_EXTRACTIONS.discard(unzipdir)
+
+
+def release_extracted_fmu() -> None:
+    """Drop the session FMU's extraction (removed once no run uses it)."""
+    with _EXTRACTIONS_LOCK:
+        unzipdir = SESSION.pop('unzipdir', None)
+        SESSION.pop('md', None)
+        if unzipdir:
+            _RETIRED_EXTRACTIONS.add(unzipdir)
+    remove_retired_extractions()
+
+
+def register_cleanup_handlers() -> None:
+    """Make sure extracted FMUs and sweep workers don't outlive the process."""
+    atexit.register(release_extracted_fmu)
+    atexit.register(shutdown_sweep_pool)
+
+
+def make_fmi_call_logger(buffer: Deque[tuple]):
+    """Capture raw FMI call/log records in a bounded buffer; see format_fmi_log()."""
+    def logger(*args):
+        buffer.append(args)
     return logger
 
 
+def format_fmi_log(records: Deque[tuple]) -> List[str]:
+    """Format records captured by make_fmi_call_logger() for the UI."""
+    lines = []
+    for args in records:
+        if len(args) == 1:
+            lines.append(str(args[0]))
+        elif len(args) == 4:
+            # comp, name, status, message (format varies)
+            comp, name, status, message = args
+            lines.append(f"[FMI] {name} -> {status} | {message}")
+        else:
+            lines.append(" ".join(str(a) for a in args))
+    return lines
+
+
 # ---------- Routes ----------
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"ok": False, "error": f"File exceeds {MAX_UPLOAD_MB} MB"}), 413
+
+
 @app.route('/')
 def index():
     return send_from_directory('static', 'index.html')
@@ -221,38 +671,76 @@ def upload_fmu():
             return jsonify({"error": "Only .fmu files allowed"}), 400
 
         # Create uploads directory if it doesn't exist
-        upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+        upload_dir = UPLOAD_DIR
         print(f"Debug: Creating/verifying upload directory: {upload_dir}")
         os.makedirs(upload_dir, exist_ok=True)
+        removed = cleanup_old_files(upload_dir)
+        if removed:
+            print(f"Debug: Removed {removed} stale file(s) from {upload_dir}")
         
         # Create a unique filename to prevent collisions
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{file.filename}"
-        fmu_path = os.path.join(upload_dir, safe_filename)
-        print(f"Debug: Saving to {fmu_path}")
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        saved_path = os.path.join(upload_dir, f"{timestamp}_{file.filename}.part")
+        print(f"Debug: Saving to {saved_path}")
         
-        # Save the file
-        file.save(fmu_path)
+        # Save the file (streamed and hashed in one pass)
+        digest = save_upload(file, saved_path)
+        if digest is None:
+            print("Debug: File too large")
+            return jsonify({"error": f"File exceeds {MAX_UPLOAD_MB} MB"}), 413
         print("Debug: File saved successfully")
-        
-        # Generate template
+
+        # Store it by content hash, so uploading the same FMU again reuses the
+        # stored copy (and the extraction below) instead of writing a new one
+        fmu_dir = os.path.join(upload_dir, digest)
+        fmu_path = os.path.join(fmu_dir, os.path.basename(file.filename))
+        if os.path.exists(fmu_path):
+            print(f"Debug: Same FMU already stored at {fmu_path}")
+            os.remove(saved_path)
+        else:
+            os.makedirs(fmu_dir, exist_ok=True)
+            os.replace(saved_path, fmu_path)
+            saved_path = fmu_path
+
+        # Model description and template are cached by stored path + mtime, so
+        # uploading an FMU again (even after others) skips the XML parse
         print("Debug: Generating template...")
-        tmpl = generate_template(fmu_path)
+        mtime = os.stat(fmu_path).st_mtime
+        md = _cached_md(fmu_path, mtime)
+        tmpl = _cached_template(fmu_path, mtime)
         print("Debug: Template generated successfully")
+
+        # Extract once; later runs read the extracted directory instead of
+        # reopening the ZIP
+        if SESSION.get('fmu_path') == fmu_path and SESSION.get('unzipdir'):
+            print("Debug: Reusing existing extraction")
+            unzipdir = SESSION['unzipdir']
+        else:
+            print("Debug: Extracting FMU...")
+            unzipdir = _fmpy().extract(fmu_path)
         
-        # Remember last FMU
+        # Remember last FMU along with its extraction
+        if SESSION.get('unzipdir') != unzipdir:
+            set_session_extraction(unzipdir, md)
         SESSION['fmu_path'] = fmu_path
+        SESSION['fmu_digest'] = digest
         print("Debug: Upload and processing completed successfully")
-        return jsonify({"ok": True, "template": tmpl, "fmuPath": fmu_path})
-        
+        # Compact by default (the UI parses it); ?pretty=1 for a human-readable template
+        pretty = request.args.get('pretty', '').lower() in ('1', 'true', 'yes')
+        return json_response({"ok": True, "template": tmpl, "fmuPath": fmu_path}, pretty=pretty)
+
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         print(f"Debug: Error in upload_fmu: {str(e)}")
         print(f"Debug: Traceback: {traceback.format_exc()}")
         # Clean up if file was partially written
-        if 'fmu_path' in locals() and os.path.exists(fmu_path):
+        if 'unzipdir' in locals() and SESSION.get('unzipdir') != unzipdir:
+            shutil.rmtree(unzipdir, ignore_errors=True)
+        if 'saved_path' in locals() and saved_path != SESSION.get('fmu_path') and os.path.exists(saved_path):
             try:
-                os.remove(fmu_path)
-                print(f"Debug: Removed partially uploaded file: {fmu_path}")
+                os.remove(saved_path)
+                print(f"Debug: Removed partially uploaded file: {saved_path}")
             except Exception as cleanup_error:
                 print(f"Debug: Error during cleanup: {str(cleanup_error)}")
         return jsonify({
@@ -266,22 +754,62 @@ def upload_fmu():
 @app.post('/api/run')
 def run_simulation():
     print("Running simulation")
-    payload = request.get_json(force=True)
+    try:
+        payload = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        return json_response({"ok": False, "error": f"Invalid JSON payload: {e}"}, 400)
     fmu_path = payload.get("fmu") or SESSION.get("fmu_path")
-    if not fmu_path or not os.path.exists(fmu_path):
-        return jsonify({"ok": False, "error": "FMU not found. Upload first."}), 400
+    try:
+        # str only: os.stat() would also accept an int and stat that file descriptor
+        fmu_stat = os.stat(fmu_path) if isinstance(fmu_path, str) and fmu_path else None
+    except (OSError, ValueError):
+        fmu_stat = None
+    if fmu_stat is None:
+        return json_response(FMU_NOT_FOUND_JSON, 400)
 
     # Build kwargs for simulate_fmu
     logs: List[str] = []
-    fmi_logger = make_fmi_call_logger(logs) if payload.get("debug_logging") else None
+    fmi_records: Deque[tuple] = deque(maxlen=FMI_LOG_MAX_LINES)
+    fmi_logger = make_fmi_call_logger(fmi_records) if payload.get("debug_logging") else None
 
-    # Prepare inputs
-    raw_inputs = payload.get("inputs", None)
-    signals = build_structured_input(raw_inputs)
+    # Prepare inputs: schedules become float64 arrays right here and stay
+    # arrays from then on
+    try:
+        signals = build_structured_input(parse_input_schedules(payload.get("inputs")))
+        runs = payload.get("runs")
+        if runs is not None and not (isinstance(runs, list) and all(isinstance(r, dict) for r in runs)):
+            raise ValueError("runs must be a list of objects")
+        for run in runs or ():
+            run["inputs"] = parse_input_schedules(run.get("inputs"))
+    except (TypeError, ValueError) as e:
+        return json_response({"ok": False, "error": f"Invalid input schedule: {e}"}, 400)
     input_file = payload.get("input_file")
+    if input_file:
+        try:
+            if not isinstance(input_file, str):
+                raise ValueError(input_file)
+            os.stat(input_file)
+        except (OSError, ValueError):
+            return json_response({"ok": False, "error": "Input file not found. Upload again."}, 400)
+
+    # Optional cap on the rows returned as JSON (default: everything, which the UI plots)
+    preview_rows = payload.get("preview_rows")
+    if preview_rows is not None and (type(preview_rows) is not int or preview_rows < 0):
+        return json_response({"ok": False, "error": "preview_rows must be a non-negative integer"}, 400)
+
+    # Reuse the extraction + parsed model description from upload when running
+    # the session FMU; FMPy then skips unzipping and XML parsing per run. The
+    # extraction is held until the run ends, so a new upload can't remove it
+    # underneath the simulation
+    extraction = acquire_session_extraction(fmu_path)
+    if extraction is not None:
+        filename, md = extraction
+    else:
+        filename, md = fmu_path, _cached_md(fmu_path, fmu_stat.st_mtime)
 
     kwargs = dict(
-        filename=fmu_path,
+        filename=filename,
+        model_description=md,
         start_time=payload.get("start_time"),
         stop_time=payload.get("stop_time"),
         # Prefer output_interval for CS; ME-only fields are accepted but may be ignored:
@@ -299,8 +827,6 @@ def run_simulation():
     )
     # Only add input if we have signals and no input file override
     if input_file:
-        if not os.path.exists(input_file):
-            return jsonify({"ok": False, "error": "Input file not found. Upload again."}), 400
         kwargs["input_file"] = input_file
     elif signals is not None:
         kwargs["input"] = signals
@@ -309,37 +835,41 @@ def run_simulation():
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
 
     try:
-        # Optional validation
-        problems = validate_fmu(fmu_path)
+        # Optional validation; given the .fmu itself (not the extraction) so
+        # FMPy also checks the ZIP entry paths
+        problems = _fmpy().validation.validate_fmu(fmu_path)
         if problems:
             for p in problems:
                 logs.append(f"{p}")
 
-        result = simulate_fmu(**kwargs)
+        # Save CSVs next to the FMU
+        ts = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        csv_prefix = os.path.join(os.path.dirname(fmu_path), f"result_{ts}")
 
-        # DataFrame for CSV and slicing
-        df = pd.DataFrame(result)
-        # Save CSV to temp
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        out_csv = os.path.join(os.path.dirname(fmu_path), f"result_{ts}.csv")
-        df.to_csv(out_csv, index=False)
+        # Parameter sweep: one simulation per entry of "runs", in parallel
+        if runs:
+            sweep = run_sweep(kwargs, runs, csv_prefix, logs, preview_rows)
+            return json_response({"ok": True, "runs": sweep, "logs": logs})
 
-       
-        return jsonify({
+        result = _fmpy().simulate_fmu(**kwargs)
+        logs.extend(format_fmi_log(fmi_records))
+
+        return json_response({
             "ok": True,
-            "columns": df.columns.tolist(),
-            "rows": df.to_dict(orient="records"),          # full data
-            "csv": out_csv,
+            **result_payload(result, f"{csv_prefix}.csv", preview_rows),
             "logs": logs,
-            "total_rows": len(df)
         })
 
     except Exception as e:
+        logs.extend(format_fmi_log(fmi_records))
         # Surface common TwinCAT dependency hint if present
         msg = str(e)
         if any("TwinCAT" in line for line in logs) or "TwinCAT" in msg:
             logs.append("Hint: Install TwinCAT 3 XAE + XAR (matching build) so registry keys like 'DataDir' exist.")
-        return jsonify({"ok": False, "error": msg, "logs": logs, "trace": traceback.format_exc()}), 500
+        return json_response({"ok": False, "error": msg, "logs": logs, "trace": traceback.format_exc()}, 500)
+    finally:
+        if extraction is not None:
+            release_extraction(extraction[0])
 
 
 @app.post('/api/upload-input')
@@ -353,15 +883,20 @@ def upload_input_file():
         if not file.filename.lower().endswith('.csv'):
             return jsonify({"ok": False, "error": "Only .csv files allowed"}), 400
 
-        upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+        upload_dir = UPLOAD_DIR
         os.makedirs(upload_dir, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        cleanup_old_files(upload_dir)
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
         safe_filename = f"{timestamp}_{file.filename}"
         input_path = os.path.join(upload_dir, safe_filename)
-        file.save(input_path)
+        if save_upload(file, input_path) is None:
+            return jsonify({"ok": False, "error": f"File exceeds {MAX_UPLOAD_MB} MB"}), 413
 
         SESSION['input_file'] = input_path
+        register_download(input_path)
         return jsonify({"ok": True, "path": input_path})
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         return jsonify({
             "ok": False,
@@ -374,13 +909,17 @@ def upload_input_file():
 @app.get('/api/download')
 def download():
     path = request.args.get('path')
-    if not path or not os.path.exists(path):
-        return jsonify({"error": "File not found"}), 404
-    # Secure: restrict to temp dirs created in this process
+    # Secure: only serve files created in this process (results / uploaded inputs)
+    if not path or os.path.realpath(path) not in SESSION.get('downloads', ()):
+        return json_response(FILE_NOT_FOUND_JSON, 404)
     try:
+        # send_file() is conditional by default (mtime/size ETag), so a
+        # repeated download is answered with 304
         return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+    except FileNotFoundError:
+        return json_response(FILE_NOT_FOUND_JSON, 404)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 
 # Serve the static files (index.html, etc.)
@@ -389,6 +928,9 @@ def statics(path):
     return send_from_directory('static', path)
 
 
+register_cleanup_handlers()
+
+
 if __name__ == '__main__':
     # For local dev; use a proper WSGI server in production (gunicorn / waitress)
     app.run(host='127.0.0.1', port=8000, debug=True)